@@ -1,7 +1,39 @@
+from itertools import chain
+
 import numpy as np
+from numba import njit, prange
+from scipy.linalg.blas import get_blas_funcs
 from tqdm import tqdm
 
 
+def _gemm(a, b, c, trans_a=False, trans_b=False, beta=0.0):
+    '''
+    Computes c = op(a) * op(b) + beta * c in place using BLAS gemm
+
+    BLAS works with Fortran-ordered matrices, so C-ordered arrays
+    should be passed transposed (it is free for them)
+    '''
+    gemm = get_blas_funcs('gemm', (a, b, c))
+    res = gemm(1.0, a, b, trans_a=trans_a, trans_b=trans_b,
+               beta=beta, c=c, overwrite_c=True)
+    if not np.shares_memory(res, c):
+        c[...] = res
+    return c
+
+
+def _empty_aligned(shape, dtype, alignment=64):
+    '''
+    Allocates an uninitialized C-ordered array whose data starts
+    at an address divisible by alignment (64 bytes fit AVX-512 loads),
+    NumPy itself only guarantees 16 bytes
+    '''
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + alignment, dtype=np.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
 def softmax(predictions):
     '''
     Computes probabilities from scores
@@ -14,15 +46,51 @@ def softmax(predictions):
       probs, np array of the same shape as predictions - 
         probability for every class, 0..1
     '''
-    is_batch = predictions.ndim == 2
-    max_pred_in_row = np.max(predictions, axis=1)[:, np.newaxis] if is_batch else np.max(predictions)
-    pred_norm = predictions - max_pred_in_row
-    pred_exp = np.exp(pred_norm)
-    sum_pred_exp = np.sum(pred_exp, axis=1)[:, np.newaxis] if is_batch else np.sum(pred_exp)
-    probs = pred_exp / sum_pred_exp
+    predictions = np.asarray(predictions, dtype=np.result_type(predictions, np.float32))
+    if predictions.ndim == 2:
+        return _softmax_2d(predictions)
+    return _softmax_1d(predictions)
+
+
+@njit(cache=True)
+def _softmax_2d(predictions):
+    '''
+    Computes softmax for a batch of scores, shape (batch_size, N)
+    '''
+    probs = np.empty_like(predictions)
+    _rowwise_softmax(predictions, probs)
     return probs
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _rowwise_softmax(predictions, out):
+    '''
+    Computes softmax of every row of predictions into out
+    in a single traversal per row, rows are processed in parallel
+    '''
+    num_classes = predictions.shape[1]
+    for i in prange(predictions.shape[0]):
+        max_pred = predictions[i, 0]
+        for j in range(1, num_classes):
+            max_pred = max(max_pred, predictions[i, j])
+
+        sum_exp = 0.0
+        for j in range(num_classes):
+            out[i, j] = np.exp(predictions[i, j] - max_pred)
+            sum_exp += out[i, j]
+        for j in range(num_classes):
+            out[i, j] /= sum_exp
+
+
+@njit(cache=True)
+def _softmax_1d(predictions):
+    '''
+    Computes softmax for scores of a single sample, shape (N)
+    '''
+    pred_exp = np.exp(predictions - np.max(predictions))
+    return pred_exp / np.sum(pred_exp)
+
+
 def cross_entropy_loss(probs, target_index):
     '''
     Computes cross-entropy loss
@@ -36,13 +104,35 @@ def cross_entropy_loss(probs, target_index):
     Returns:
       loss: single value
     '''
-    is_batch = probs.ndim == 2
-    target_probs = probs[np.arange(target_index.size), target_index] if is_batch else probs[target_index]
-    loss = -np.mean(np.log(target_probs))
-    return loss
+    target_index = np.atleast_1d(target_index)
+    # kernels don't check bounds, a single sample may have several targets
+    batch_size = probs.shape[0] if probs.ndim == 2 else target_index.size
+    target_index = _check_target_index(target_index, (batch_size, probs.shape[-1]))
+    if probs.ndim == 2:
+        return _ce_2d(probs, target_index)
+    return _ce_1d(probs, target_index)
+
+
+@njit(cache=True)
+def _ce_2d(probs, target_index):
+    '''
+    Computes cross_entropy_loss for a batch of probabilities, shape (batch_size, N)
+    '''
+    loss = 0.0
+    for i in range(target_index.size):
+        loss -= np.log(probs[i, target_index[i]])
+    return loss / target_index.size
+
+
+@njit(cache=True)
+def _ce_1d(probs, target_index):
+    '''
+    Computes cross_entropy_loss for probabilities of a single sample, shape (N)
+    '''
+    return -np.mean(np.log(probs[target_index]))
 
 
-def softmax_with_cross_entropy(predictions, target_index):
+def softmax_with_cross_entropy(predictions, target_index, out=None):
     '''
     Computes softmax and cross-entropy loss for model predictions,
     including the gradient
@@ -52,24 +142,85 @@ def softmax_with_cross_entropy(predictions, target_index):
         classifier output
       target_index: np array of int, shape is (1) or (batch_size) -
         index of the true class for given sample(s)
+      out: optional float np array same shape as predictions -
+        buffer for the gradient, may be predictions itself
 
     Returns:
       loss, single value - cross-entropy loss
       dprediction, np array same shape as predictions - gradient of predictions by loss value
     '''
-    probs = softmax(predictions)
-    loss = cross_entropy_loss(probs, target_index)
-    
-    is_batch = probs.ndim == 2
-    dprediction = probs
-    
-    if is_batch:
-        dprediction[np.arange(target_index.size), target_index] -= 1
-        dprediction /= target_index.size
-    else:
-        dprediction[target_index] -= 1
-        
-    return loss, dprediction
+    if predictions.ndim == 2:
+        return _softmax_with_cross_entropy_2d(predictions, target_index, out)
+
+    if out is not None:
+        out = out[np.newaxis, :]
+    loss, dprediction = _softmax_with_cross_entropy_2d(predictions[np.newaxis, :],
+                                                       np.atleast_1d(target_index), out)
+    return loss, dprediction[0]
+
+
+def _softmax_with_cross_entropy_2d(predictions, target_index, out=None):
+    '''
+    Computes softmax_with_cross_entropy for a batch of scores, shape (batch_size, N)
+    '''
+    if out is None:
+        out = np.empty(predictions.shape, dtype=np.result_type(predictions, np.float32))
+    target_index = _check_target_index(target_index, predictions.shape)
+    if out is not predictions:
+        out[...] = predictions
+    loss = _softmax_cross_entropy_rows(out, target_index)
+    return loss, out
+
+
+def _check_target_index(target_index, shape):
+    '''
+    Validates target_index against scores of given shape, (batch_size, N),
+    before it reaches kernels without bounds checking
+
+    Returns:
+      target_index, np array of int, shape (batch_size) - negative indices
+        converted to 0..N-1
+    '''
+    batch_size, num_classes = shape
+    target_index = np.asarray(target_index)
+    if target_index.shape != (batch_size,):
+        raise ValueError('target_index of shape %s does not match %d samples'
+                         % (target_index.shape, batch_size))
+    if np.any(target_index < -num_classes) or np.any(target_index >= num_classes):
+        raise IndexError('target_index is out of bounds for %d classes' % num_classes)
+    return np.where(target_index < 0, target_index + num_classes, target_index)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _softmax_cross_entropy_rows(scores, target_index):
+    '''
+    Overwrites scores, shape (batch_size, N), with the gradient of
+    mean cross-entropy loss of their softmax, rows are processed in parallel
+
+    log(softmax) = z - log(sum(exp(z))), so probabilities never have to be
+    materialized for the loss and a single exp pass serves both outputs
+
+    Returns:
+      loss, single value - cross-entropy loss
+    '''
+    batch_size, num_classes = scores.shape
+    losses = np.empty(batch_size, dtype=scores.dtype)
+    for i in prange(batch_size):
+        max_z = scores[i, 0]
+        for j in range(1, num_classes):
+            max_z = max(max_z, scores[i, j])
+        target_z = scores[i, target_index[i]] - max_z
+
+        sum_exp = 0.0
+        for j in range(num_classes):
+            scores[i, j] = np.exp(scores[i, j] - max_z)
+            sum_exp += scores[i, j]
+        losses[i] = np.log(sum_exp) - target_z
+
+        for j in range(num_classes):
+            scores[i, j] /= sum_exp * batch_size
+        scores[i, target_index[i]] -= 1.0 / batch_size
+    return np.mean(losses)
 
 
 def l2_regularization(W, reg_strength):
@@ -84,12 +235,13 @@ def l2_regularization(W, reg_strength):
       loss, single value - l2 regularization loss
       gradient, np.array same shape as W - gradient of weight by l2 loss
     '''
-    loss = reg_strength * np.sum(W ** 2)
+    W_flat = W.ravel()
+    loss = reg_strength * np.dot(W_flat, W_flat)
     grad = 2 * reg_strength * W
     return loss, grad
     
 
-def linear_softmax(X, W, target_index):
+def linear_softmax(X, W, target_index, pred_buf=None, dW_buf=None):
     '''
     Performs linear classification and returns loss and gradient over W
 
@@ -97,21 +249,161 @@ def linear_softmax(X, W, target_index):
       X, np array, shape (num_batch, num_features) - batch of images
       W, np array, shape (num_features, classes) - weights
       target_index, np array, shape (num_batch) - index of target classes
+      pred_buf, optional np array, shape (num_batch, classes) - buffer
+        for predictions and their gradient
+      dW_buf, optional np array same shape as W - buffer for the gradient
 
     Returns:
       loss, single value - cross-entropy loss
       gradient, np.array same shape as W - gradient of weight by loss
 
     '''
-    predictions = np.dot(X, W)
-    loss, dprediction = softmax_with_cross_entropy(predictions, target_index)
-    dW = np.dot(X.T, dprediction)
+    dtype = np.result_type(X, W, np.float32)
+    if pred_buf is None:
+        pred_buf = np.empty((X.shape[0], W.shape[1]), dtype=dtype)
+    if dW_buf is None:
+        dW_buf = np.empty(W.shape, dtype=dtype)
+
+    # predictions.T = W.T * X.T
+    predictions = _gemm(W.T, X.T, pred_buf.T).T
+    loss, dprediction = _softmax_with_cross_entropy_2d(predictions, target_index, out=predictions)
+    # dW.T = dprediction.T * X
+    dW = _gemm(dprediction.T, X.T, dW_buf.T, trans_b=True).T
     return loss, dW
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _sgd_step(X, W, y, reg, learning_rate, pred_buf, dW_buf):
+    '''
+    Performs one SGD step of L2-regularized linear softmax classifier,
+    updating W in place
+
+    Arguments:
+      X, np array, shape (num_batch, num_features) - batch of images
+      W, np array, shape (num_features, classes) - weights, same dtype as X
+      y, np array, shape (num_batch) - index of target classes
+      reg, float - L2 regularization strength
+      learning_rate, float - learning rate for gradient descent
+      pred_buf, np array, shape (num_batch, classes) - buffer for predictions
+        and their gradient
+      dW_buf, np array same shape as W - buffer for the gradient
+
+    Returns:
+      loss, single value - loss of the batch before the update
+    '''
+    dprediction = np.dot(X, W, pred_buf)
+    loss = _softmax_cross_entropy_rows(dprediction, y)
+    W_flat = W.reshape(-1)
+    loss += reg * np.dot(W_flat, W_flat)
+
+    # L2 gradient is applied as weight decay: W - lr * (dW + 2 * reg * W)
+    dW = np.dot(X.T, dprediction, dW_buf)
+    W *= 1 - 2 * learning_rate * reg
+    W -= learning_rate * dW
+    return loss
+
+
+def _sgd_step_xp(xp, X, W, y, reg, learning_rate):
+    '''
+    Same as _sgd_step for arrays of NumPy-compatible module xp
+    (e.g. CuPy), which Numba can't compile
+
+    Returns:
+      loss, array of single value - loss of the batch before the update
+    '''
+    batch_size = X.shape[0]
+    rows = xp.arange(batch_size)
+
+    dprediction = xp.dot(X, W)
+    dprediction -= xp.max(dprediction, axis=1, keepdims=True)
+    target_pred = dprediction[rows, y]
+    xp.exp(dprediction, out=dprediction)
+    sum_exp = xp.sum(dprediction, axis=1, keepdims=True)
+
+    W_flat = W.ravel()
+    loss = xp.mean(xp.log(sum_exp[:, 0]) - target_pred) + reg * xp.dot(W_flat, W_flat)
+
+    dprediction /= sum_exp * batch_size
+    dprediction[rows, y] -= 1.0 / batch_size
+
+    dW = xp.dot(X.T, dprediction)
+    W *= 1 - 2 * learning_rate * reg
+    W -= learning_rate * dW
+    return loss
+
+
+def _shuffled_batches(num_train, batch_size):
+    '''
+    Splits a random permutation of num_train samples into minibatches
+
+    Returns:
+      iterable of np arrays of int - indices of every minibatch
+    '''
+    shuffled_indices = np.arange(num_train)
+    np.random.shuffle(shuffled_indices)
+    num_full = num_train // batch_size * batch_size
+    full_batches = shuffled_indices[:num_full].reshape(-1, batch_size)
+    tail = shuffled_indices[num_full:]
+    return chain(full_batches, [tail] if tail.size else [])
+
+
+@njit(parallel=True, cache=True)
+def _predict_int8(X, W_q, W_scale, y_pred):
+    '''
+    Predicts classes with int8 weights, quantizing every sample to int8
+    with its own scale, samples are processed in parallel
+
+    Arguments:
+      X, np array, shape (num_samples, num_features) - samples
+      W_q, np array of int8, shape (num_features, classes) - quantized weights,
+        Fortran-ordered so every class is contiguous
+      W_scale, np array, shape (classes) - scale of every column of W_q
+      y_pred, np array of int, shape (num_samples) - receives predictions
+    '''
+    num_features, num_classes = W_q.shape
+    for i in prange(X.shape[0]):
+        max_x = 0.0
+        for k in range(num_features):
+            max_x = max(max_x, abs(X[i, k]))
+        # a positive per-sample scale doesn't change its argmax
+        x_scale = 127.0 / max_x if max_x > 0 else 1.0
+
+        x_q = np.empty(num_features, dtype=np.int32)
+        for k in range(num_features):
+            x_q[k] = round(X[i, k] * x_scale)
+
+        # |x_q * w_q| <= 127 * 127, sums stay exact in int32
+        # for up to 2 ** 31 / 127 ** 2 > 100000 features
+        acc = np.zeros(num_classes, dtype=np.int32)
+        for j in range(num_classes):
+            for k in range(num_features):
+                acc[j] += x_q[k] * np.int32(W_q[k, j])
+
+        best = 0
+        best_score = acc[0] * W_scale[0]
+        for j in range(1, num_classes):
+            score = acc[j] * W_scale[j]
+            if score > best_score:
+                best = j
+                best_score = score
+        y_pred[i] = best
+
+
 class LinearSoftmaxClassifier():
-    def __init__(self):
+    __slots__ = ('W', 'W_q', 'W_scale', 'xp', '_pred_buf', '_dW_buf')
+
+    def __init__(self, xp=np):
+        '''
+        Arguments:
+          xp - NumPy-compatible array module to train and predict with,
+            e.g. cupy to run on GPU
+        '''
         self.W = None
+        self.W_q = None
+        self.W_scale = None
+        self.xp = xp
+        self._pred_buf = None
+        self._dW_buf = None
 
     def fit(self, X, y, batch_size=100, learning_rate=1e-7, reg=1e-5,
             epochs=1):
@@ -130,32 +422,87 @@ class LinearSoftmaxClassifier():
         num_train = X.shape[0]
         num_features = X.shape[1]
         num_classes = np.max(y)+1
+        # weights are about to change, quantized copy becomes stale
+        self.W_q = None
+        self.W_scale = None
         if self.W is None:
-            self.W = 0.001 * np.random.randn(num_features, num_classes)
+            self.W = _empty_aligned((num_features, num_classes), np.float32)
+            self.W[...] = 0.001 * np.random.randn(num_features, num_classes)
+        if self.xp is not np:
+            return self._fit_xp(X, y, batch_size, learning_rate, reg, epochs)
+
+        X = np.ascontiguousarray(X, dtype=self.W.dtype)
+        # W may come from an earlier fit with fewer classes,
+        # _sgd_step doesn't check bounds
+        y = _check_target_index(y, (num_train, self.W.shape[1])).astype(np.int32)
+
+        # minibatches are gathered into the same buffers every step
+        scratch_X = _empty_aligned((batch_size, num_features), X.dtype)
+        scratch_y = np.empty(batch_size, dtype=y.dtype)
+        # buffers follow W, which may have more classes than the labels of this call
+        pred_shape = (batch_size, self.W.shape[1])
+        if (self._pred_buf is None or self._pred_buf.shape != pred_shape
+                or self._pred_buf.dtype != self.W.dtype):
+            self._pred_buf = _empty_aligned(pred_shape, self.W.dtype)
+        if (self._dW_buf is None or self._dW_buf.shape != self.W.shape
+                or self._dW_buf.dtype != self.W.dtype):
+            self._dW_buf = _empty_aligned(self.W.shape, self.W.dtype)
 
         loss_history = []
         for epoch in tqdm(range(epochs)):
-            shuffled_indices = np.arange(num_train)
-            np.random.shuffle(shuffled_indices)
-            sections = np.arange(batch_size, num_train, batch_size)
-            batches_indices = np.array_split(shuffled_indices, sections)
-
             loss = 0
             cnt = 0
-            for batch_indices in batches_indices:
-                batch_X = X[batch_indices]
-                batch_y = y[batch_indices]
-                loss1, dW1 = linear_softmax(batch_X, self.W, batch_y)
-                loss2, dW2 = l2_regularization(self.W, reg)
-                loss += loss1 + loss2
-                dW = dW1 + dW2
-                self.W -= learning_rate * dW
+            for batch_indices in _shuffled_batches(num_train, batch_size):
+                cur_batch_size = batch_indices.size
+                batch_X = np.take(X, batch_indices, axis=0, out=scratch_X[:cur_batch_size])
+                batch_y = np.take(y, batch_indices, out=scratch_y[:cur_batch_size])
+                loss += _sgd_step(batch_X, self.W, batch_y, reg, learning_rate,
+                                  self._pred_buf[:cur_batch_size], self._dW_buf)
                 cnt += 1
                 
             loss_history.append(loss / cnt)
 
         return loss_history
 
+    def _fit_xp(self, X, y, batch_size, learning_rate, reg, epochs):
+        '''
+        Trains linear classifier with array module self.xp,
+        see fit for arguments
+        '''
+        xp = self.xp
+        # data is uploaded once, only minibatch indices come from the host
+        self.W = xp.asarray(self.W)
+        X = xp.asarray(X, dtype=self.W.dtype)
+        y = xp.asarray(y, dtype=np.int32)
+
+        loss_history = []
+        for epoch in tqdm(range(epochs)):
+            loss = 0
+            cnt = 0
+            for batch_indices in _shuffled_batches(X.shape[0], batch_size):
+                batch_indices = xp.asarray(batch_indices)
+                loss += _sgd_step_xp(xp, X[batch_indices], self.W, y[batch_indices],
+                                     reg, learning_rate)
+                cnt += 1
+
+            loss_history.append(float(loss) / cnt)
+
+        return loss_history
+
+    def quantize(self):
+        '''
+        Stores int8 copy of trained weights with per-class scale,
+        predict uses it until the next fit
+        '''
+        if self.W is None:
+            raise ValueError('Classifier has to be fit before quantize')
+        xp = self.xp
+        scale = xp.max(xp.abs(self.W), axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        # columns are contiguous for the per-class dot products of predict
+        self.W_q = xp.asfortranarray(xp.round(self.W / scale).astype(np.int8))
+        self.W_scale = scale.astype(np.float32)
+
     def predict(self, X):
         '''
         Produces classifier predictions on the set
@@ -166,15 +513,34 @@ class LinearSoftmaxClassifier():
         Returns:
           y_pred, np.array of int (test_samples)
         '''
-        y = np.dot(X, self.W)
-        y_pred = np.argmax(y, axis=1)
-        return y_pred
-
+        if self.W_q is not None:
+            return self._predict_quantized(X)
 
+        if self.xp is not np:
+            y = self.xp.dot(self.xp.asarray(X, dtype=self.W.dtype), self.W)
+            return self.xp.asnumpy(self.xp.argmax(y, axis=1))
 
-                
-                                                          
-
-            
+        # float64 input isn't allowed to promote inference with float32 weights
+        y = np.dot(np.asarray(X, dtype=self.W.dtype), self.W)
+        y_pred = np.argmax(y, axis=1)
+        return y_pred
 
-                
+    def _predict_quantized(self, X):
+        '''
+        Produces predictions with int8 weights from quantize,
+        see predict for arguments
+        '''
+        xp = self.xp
+        if xp is np:
+            X = np.asarray(X, dtype=np.float32)
+            y_pred = np.empty(X.shape[0], dtype=np.intp)
+            _predict_int8(X, self.W_q, self.W_scale, y_pred)
+            return y_pred
+
+        # Numba can't compile for xp, integer matmul of the module is used
+        X = xp.asarray(X, dtype=np.float32)
+        X_scale = xp.max(xp.abs(X), axis=1, keepdims=True)
+        X_scale[X_scale == 0] = 127.0
+        X_q = xp.round(X * (127.0 / X_scale)).astype(np.int32)
+        y = xp.dot(X_q, self.W_q.astype(np.int32)) * self.W_scale
+        return xp.asnumpy(xp.argmax(y, axis=1))
@@ -62,6 +62,12 @@ def check_layer_gradient(layer, x, delta=1e-5, tol=1e-4):
     Returns:
       bool indicating whether gradients match or not
     """
+    # Layers compute in the dtype of their parameters, float32 is
+    # too coarse for numerical gradient, so they are checked in float64
+    for param in layer.params().values():
+        param.value = param.value.astype(np.float64)
+        param.grad = np.zeros_like(param.value)
+
     output = layer.forward(x)
     output_weight = np.random.randn(*output.shape)
 
@@ -92,7 +98,9 @@ def check_layer_param_gradient(layer, x,
       bool indicating whether gradients match or not
     """
     param = layer.params()[param_name]
-    initial_w = param.value
+    # Parameters are stored in float32, which is too coarse
+    # for numerical gradient, so they are checked in float64
+    initial_w = param.value.astype(np.float64)
 
     output = layer.forward(x)
     output_weight = np.random.randn(*output.shape)
@@ -129,7 +137,7 @@ def check_model_gradient(model, X, y,
     for param_key in params:
         print("Checking gradient for %s" % param_key)
         param = params[param_key]
-        initial_w = param.value
+        initial_w = param.value.astype(np.float64)
 
         def helper_func(w):
             param.value = w
@@ -1,4 +1,31 @@
 import numpy as np
+from numba import njit, prange
+from scipy.linalg.blas import get_blas_funcs
+
+
+def _reuse_buffer(buffer, shape, dtype):
+    """
+    Returns buffer if it can hold an array of given shape and dtype,
+    otherwise allocates a new one
+    """
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+    return buffer
+
+
+def _gemm(a, b, c, trans_a=False, trans_b=False, beta=0.0):
+    """
+    Computes c = op(a) * op(b) + beta * c in place using BLAS gemm
+
+    BLAS works with Fortran-ordered matrices, so C-ordered arrays
+    should be passed transposed (it is free for them)
+    """
+    gemm = get_blas_funcs('gemm', (a, b, c))
+    res = gemm(1.0, a, b, trans_a=trans_a, trans_b=trans_b,
+               beta=beta, c=c, overwrite_c=True)
+    if not np.shares_memory(res, c):
+        c[...] = res
+    return c
 
 
 def l2_regularization(W, reg_strength):
@@ -13,7 +40,8 @@ def l2_regularization(W, reg_strength):
       loss, single value - l2 regularization loss
       gradient, np.array same shape as W - gradient of weight by l2 loss
     """
-    loss = reg_strength * np.sum(W ** 2)
+    W_flat = W.ravel()
+    loss = reg_strength * np.dot(W_flat, W_flat)
     grad = 2 * reg_strength * W
     return loss, grad
 
@@ -30,15 +58,51 @@ def softmax(predictions):
       probs, np array of the same shape as predictions - 
         probability for every class, 0..1
     '''
-    is_batch = predictions.ndim == 2
-    max_pred_in_row = np.max(predictions, axis=1)[:, np.newaxis] if is_batch else np.max(predictions)
-    pred_norm = predictions - max_pred_in_row
-    pred_exp = np.exp(pred_norm)
-    sum_pred_exp = np.sum(pred_exp, axis=1)[:, np.newaxis] if is_batch else np.sum(pred_exp)
-    probs = pred_exp / sum_pred_exp
+    predictions = np.asarray(predictions, dtype=np.result_type(predictions, np.float32))
+    if predictions.ndim == 2:
+        return _softmax_2d(predictions)
+    return _softmax_1d(predictions)
+
+
+@njit(cache=True)
+def _softmax_2d(predictions):
+    '''
+    Computes softmax for a batch of scores, shape (batch_size, N)
+    '''
+    probs = np.empty_like(predictions)
+    _rowwise_softmax(predictions, probs)
     return probs
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _rowwise_softmax(predictions, out):
+    '''
+    Computes softmax of every row of predictions into out
+    in a single traversal per row, rows are processed in parallel
+    '''
+    num_classes = predictions.shape[1]
+    for i in prange(predictions.shape[0]):
+        max_pred = predictions[i, 0]
+        for j in range(1, num_classes):
+            max_pred = max(max_pred, predictions[i, j])
+
+        sum_exp = 0.0
+        for j in range(num_classes):
+            out[i, j] = np.exp(predictions[i, j] - max_pred)
+            sum_exp += out[i, j]
+        for j in range(num_classes):
+            out[i, j] /= sum_exp
+
+
+@njit(cache=True)
+def _softmax_1d(predictions):
+    '''
+    Computes softmax for scores of a single sample, shape (N)
+    '''
+    pred_exp = np.exp(predictions - np.max(predictions))
+    return pred_exp / np.sum(pred_exp)
+
+
 def cross_entropy_loss(probs, target_index):
     '''
     Computes cross-entropy loss
@@ -52,13 +116,35 @@ def cross_entropy_loss(probs, target_index):
     Returns:
       loss: single value
     '''
-    is_batch = probs.ndim == 2
-    target_probs = probs[np.arange(target_index.size), target_index] if is_batch else probs[target_index]
-    loss = -np.mean(np.log(target_probs))
-    return loss
+    target_index = np.atleast_1d(target_index)
+    # kernels don't check bounds, a single sample may have several targets
+    batch_size = probs.shape[0] if probs.ndim == 2 else target_index.size
+    target_index = _check_target_index(target_index, (batch_size, probs.shape[-1]))
+    if probs.ndim == 2:
+        return _ce_2d(probs, target_index)
+    return _ce_1d(probs, target_index)
+
+
+@njit(cache=True)
+def _ce_2d(probs, target_index):
+    '''
+    Computes cross_entropy_loss for a batch of probabilities, shape (batch_size, N)
+    '''
+    loss = 0.0
+    for i in range(target_index.size):
+        loss -= np.log(probs[i, target_index[i]])
+    return loss / target_index.size
+
+
+@njit(cache=True)
+def _ce_1d(probs, target_index):
+    '''
+    Computes cross_entropy_loss for probabilities of a single sample, shape (N)
+    '''
+    return -np.mean(np.log(probs[target_index]))
 
 
-def softmax_with_cross_entropy(predictions, target_index):
+def softmax_with_cross_entropy(predictions, target_index, out=None):
     """
     Computes softmax and cross-entropy loss for model predictions,
     including the gradient
@@ -68,24 +154,85 @@ def softmax_with_cross_entropy(predictions, target_index):
         classifier output
       target_index: np array of int, shape is (1) or (batch_size) -
         index of the true class for given sample(s)
+      out: optional float np array same shape as predictions -
+        buffer for the gradient, may be predictions itself
 
     Returns:
       loss, single value - cross-entropy loss
       dprediction, np array same shape as predictions - gradient of predictions by loss value
     """
-    probs = softmax(predictions)
-    loss = cross_entropy_loss(probs, target_index)
-    
-    is_batch = probs.ndim == 2
-    dprediction = probs
-    
-    if is_batch:
-        dprediction[np.arange(target_index.size), target_index] -= 1
-        dprediction /= target_index.size
-    else:
-        dprediction[target_index] -= 1
-        
-    return loss, dprediction
+    if predictions.ndim == 2:
+        return _softmax_with_cross_entropy_2d(predictions, target_index, out)
+
+    if out is not None:
+        out = out[np.newaxis, :]
+    loss, dprediction = _softmax_with_cross_entropy_2d(predictions[np.newaxis, :],
+                                                       np.atleast_1d(target_index), out)
+    return loss, dprediction[0]
+
+
+def _softmax_with_cross_entropy_2d(predictions, target_index, out=None):
+    '''
+    Computes softmax_with_cross_entropy for a batch of scores, shape (batch_size, N)
+    '''
+    if out is None:
+        out = np.empty(predictions.shape, dtype=np.result_type(predictions, np.float32))
+    target_index = _check_target_index(target_index, predictions.shape)
+    if out is not predictions:
+        out[...] = predictions
+    loss = _softmax_cross_entropy_rows(out, target_index)
+    return loss, out
+
+
+def _check_target_index(target_index, shape):
+    '''
+    Validates target_index against scores of given shape, (batch_size, N),
+    before it reaches kernels without bounds checking
+
+    Returns:
+      target_index, np array of int, shape (batch_size) - negative indices
+        converted to 0..N-1
+    '''
+    batch_size, num_classes = shape
+    target_index = np.asarray(target_index)
+    if target_index.shape != (batch_size,):
+        raise ValueError('target_index of shape %s does not match %d samples'
+                         % (target_index.shape, batch_size))
+    if np.any(target_index < -num_classes) or np.any(target_index >= num_classes):
+        raise IndexError('target_index is out of bounds for %d classes' % num_classes)
+    return np.where(target_index < 0, target_index + num_classes, target_index)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _softmax_cross_entropy_rows(scores, target_index):
+    '''
+    Overwrites scores, shape (batch_size, N), with the gradient of
+    mean cross-entropy loss of their softmax, rows are processed in parallel
+
+    log(softmax) = z - log(sum(exp(z))), so probabilities never have to be
+    materialized for the loss and a single exp pass serves both outputs
+
+    Returns:
+      loss, single value - cross-entropy loss
+    '''
+    batch_size, num_classes = scores.shape
+    losses = np.empty(batch_size, dtype=scores.dtype)
+    for i in prange(batch_size):
+        max_z = scores[i, 0]
+        for j in range(1, num_classes):
+            max_z = max(max_z, scores[i, j])
+        target_z = scores[i, target_index[i]] - max_z
+
+        sum_exp = 0.0
+        for j in range(num_classes):
+            scores[i, j] = np.exp(scores[i, j] - max_z)
+            sum_exp += scores[i, j]
+        losses[i] = np.log(sum_exp) - target_z
+
+        for j in range(num_classes):
+            scores[i, j] /= sum_exp * batch_size
+        scores[i, target_index[i]] -= 1.0 / batch_size
+    return np.mean(losses)
 
 
 class Param:
@@ -93,20 +240,65 @@ class Param:
     Trainable parameter of the model
     Captures both parameter value and the gradient
     """
+    __slots__ = ('value', 'grad')
 
     def __init__(self, value):
         self.value = value
         self.grad = np.zeros_like(value)
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _relu_forward(X, out, mask_bits):
+    """
+    Computes out = max(X, 0) and packs the mask X >= 0 into bits,
+    8 features per byte in np.packbits(axis=1) order
+    """
+    num_features = X.shape[1]
+    for i in prange(X.shape[0]):
+        mask_bits[i, :] = 0
+        for j in range(num_features):
+            if X[i, j] >= 0:
+                out[i, j] = X[i, j]
+                mask_bits[i, j >> 3] |= 128 >> (j & 7)
+            else:
+                out[i, j] = 0
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _relu_backward(d_out, mask_bits, d_in):
+    """
+    Computes d_in = d_out where the packed mask bit is set, 0 elsewhere
+    """
+    num_features = d_out.shape[1]
+    for i in prange(d_out.shape[0]):
+        for j in range(num_features):
+            bit = (mask_bits[i, j >> 3] >> (7 - (j & 7))) & 1
+            d_in[i, j] = d_out[i, j] * bit
+
+
 class ReLULayer:
+    __slots__ = ('_out', '_mask_bits', '_din')
+
     def __init__(self):
-        pass
+        self._out = None
+        self._mask_bits = None
+        self._din = None
 
     def forward(self, X):
-        self.X = X
-        res = np.maximum(0, X)
-        return res
+        """
+        Forward pass
+
+        Returns:
+        result: np array same shape as X - the layer's internal buffer,
+          overwritten by the next forward, copy it to keep it longer
+        """
+        # features are flattened so the mask is packed row by row
+        X_2d = X.reshape(X.shape[0], -1)
+        mask_shape = (X_2d.shape[0], (X_2d.shape[1] + 7) // 8)
+        self._out = _reuse_buffer(self._out, X.shape, X.dtype)
+        self._mask_bits = _reuse_buffer(self._mask_bits, mask_shape, np.uint8)
+        _relu_forward(X_2d, self._out.reshape(X_2d.shape), self._mask_bits)
+        return self._out
         
     def backward(self, d_out):
         """
@@ -118,11 +310,13 @@ class ReLULayer:
 
         Returns:
         d_result: np array (batch_size, num_features) - gradient
-          with respect to input
+          with respect to input, the layer's internal buffer,
+          overwritten by the next backward
         """
-        d_result = d_out.copy()
-        d_result[self.X < 0] = 0
-        return d_result
+        self._din = _reuse_buffer(self._din, d_out.shape, d_out.dtype)
+        d_out_2d = d_out.reshape(d_out.shape[0], -1)
+        _relu_backward(d_out_2d, self._mask_bits, self._din.reshape(d_out_2d.shape))
+        return self._din
 
     def params(self):
         # ReLU Doesn't have any parameters
@@ -130,15 +324,32 @@ class ReLULayer:
 
 
 class FullyConnectedLayer:
+    __slots__ = ('W', 'B', 'X', '_res', '_din')
+
     def __init__(self, n_input, n_output):
-        self.W = Param(0.001 * np.random.randn(n_input, n_output))
-        self.B = Param(0.001 * np.random.randn(1, n_output))
+        self.W = Param((0.001 * np.random.randn(n_input, n_output)).astype(np.float32))
+        self.B = Param((0.001 * np.random.randn(1, n_output)).astype(np.float32))
         self.X = None
+        self._res = None
+        self._din = None
 
     def forward(self, X):
+        """
+        Forward pass
+
+        Returns:
+        result: np array (batch_size, n_output) - the layer's internal buffer,
+          overwritten by the next forward, copy it to keep it longer
+        """
+        # activations follow the parameters, a float64 input isn't
+        # allowed to promote the whole layer
+        dtype = np.result_type(self.W.value, self.B.value)
+        X = np.asarray(X, dtype=dtype)
         self.X = X
-        res = np.dot(X, self.W.value) + self.B.value
-        return res
+        self._res = _reuse_buffer(self._res, (X.shape[0], self.W.value.shape[1]), dtype)
+        np.dot(X, self.W.value, out=self._res)
+        self._res += self.B.value
+        return self._res
         
     def backward(self, d_out):
         """
@@ -152,12 +363,21 @@ class FullyConnectedLayer:
 
         Returns:
         d_result: np array (batch_size, n_input) - gradient
-          with respect to input
+          with respect to input, the layer's internal buffer,
+          overwritten by the next backward
         """
-        self.W.grad += np.dot(self.X.T, d_out)
+        d_out = np.asarray(d_out, dtype=self.X.dtype)
+        # W.grad.T += d_out.T * X
+        _gemm(d_out.T, self.X.T, self.W.grad.T, trans_b=True, beta=1.0)
         self.B.grad += np.sum(d_out, axis=0)
-        d_result = np.dot(d_out, self.W.value.T)
-        return d_result
+
+        din_shape = (d_out.shape[0], self.W.value.shape[0])
+        self._din = _reuse_buffer(self._din, din_shape, d_out.dtype)
+        # din.T = W * d_out.T
+        _gemm(self.W.value.T, d_out.T, self._din.T, trans_a=True)
+        # input isn't needed anymore, let it be freed before the next forward
+        self.X = None
+        return self._din
 
     def params(self):
         return {'W': self.W, 'B': self.B}
@@ -1,12 +1,112 @@
 import numpy as np
+from numba import njit, prange
 
-from layers import FullyConnectedLayer, ReLULayer, softmax_with_cross_entropy, l2_regularization
+from layers import FullyConnectedLayer, ReLULayer, _check_target_index, _softmax_cross_entropy_rows
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _two_layer_step(X, W1, B1, W2, B2, y, dW1, dB1, dW2, dB2, reg):
+    """
+    Runs forward and backward pass of FC -> ReLU -> FC -> Softmax network
+    with L2 regularization of weights
+
+    All arrays are expected to be C-contiguous and have the same float dtype,
+    gradients are written (not accumulated) into dW1, dB1, dW2 and dB2
+
+    Returns:
+    loss, single value - cross-entropy loss plus L2 regularization loss
+    """
+    batch_size = X.shape[0]
+    hidden_size = W1.shape[1]
+    num_classes = W2.shape[1]
+
+    # hidden activations after ReLU, the mask keeps the sign of
+    # pre-activations, gradient passes at 0 as in ReLULayer
+    A = np.dot(X, W1)
+    mask = np.empty(A.shape, dtype=np.bool_)
+    for i in prange(batch_size):
+        for j in range(hidden_size):
+            A[i, j] += B1[0, j]
+            mask[i, j] = A[i, j] >= 0
+            A[i, j] = max(A[i, j], 0.0)
+
+    # softmax with cross-entropy, dZ overwrites the scores
+    dZ = np.dot(A, W2)
+    for i in prange(batch_size):
+        for j in range(num_classes):
+            dZ[i, j] += B2[0, j]
+    loss = _softmax_cross_entropy_rows(dZ, y)
+
+    np.dot(A.T, dZ, dW2)
+    dB2[0, :] = dZ.sum(axis=0)
+
+    dH = np.dot(dZ, W2.T)
+    for i in prange(batch_size):
+        for j in range(hidden_size):
+            if not mask[i, j]:
+                dH[i, j] = 0.0
+
+    np.dot(X.T, dH, dW1)
+    dB1[0, :] = dH.sum(axis=0)
+
+    W1_flat = W1.reshape(-1)
+    W2_flat = W2.reshape(-1)
+    loss += reg * (np.dot(W1_flat, W1_flat) + np.dot(W2_flat, W2_flat))
+    for i in prange(W1.shape[0]):
+        for j in range(hidden_size):
+            dW1[i, j] += 2 * reg * W1[i, j]
+    for i in prange(hidden_size):
+        for j in range(num_classes):
+            dW2[i, j] += 2 * reg * W2[i, j]
+
+    return loss
+
+
+def _two_layer_step_xp(xp, X, W1, B1, W2, B2, y, dW1, dB1, dW2, dB2, reg):
+    """
+    Same as _two_layer_step for arrays of NumPy-compatible module xp
+    (e.g. CuPy), which Numba can't compile
+    """
+    batch_size = X.shape[0]
+    rows = xp.arange(batch_size)
+
+    A = xp.dot(X, W1)
+    A += B1
+    mask = A >= 0
+    xp.maximum(A, 0, out=A)
+
+    dZ = xp.dot(A, W2)
+    dZ += B2
+    dZ -= xp.max(dZ, axis=1, keepdims=True)
+    target_z = dZ[rows, y]
+    xp.exp(dZ, out=dZ)
+    sum_exp = xp.sum(dZ, axis=1, keepdims=True)
+    loss = xp.mean(xp.log(sum_exp[:, 0]) - target_z)
+    dZ /= sum_exp * batch_size
+    dZ[rows, y] -= 1.0 / batch_size
+
+    xp.dot(A.T, dZ, out=dW2)
+    dB2[...] = xp.sum(dZ, axis=0, keepdims=True)
+
+    dH = xp.dot(dZ, W2.T)
+    dH *= mask
+    xp.dot(X.T, dH, out=dW1)
+    dB1[...] = xp.sum(dH, axis=0, keepdims=True)
+
+    W1_flat = W1.ravel()
+    W2_flat = W2.ravel()
+    loss += reg * (xp.dot(W1_flat, W1_flat) + xp.dot(W2_flat, W2_flat))
+    dW1 += 2 * reg * W1
+    dW2 += 2 * reg * W2
+
+    return float(loss)
 
 
 class TwoLayerNet:
     """ Neural network with two fully connected layers """
+    __slots__ = ('reg', 'xp', 'layers', '_params', '_step_params')
 
-    def __init__(self, n_input, n_output, hidden_layer_size, reg):
+    def __init__(self, n_input, n_output, hidden_layer_size, reg, xp=np):
         """
         Initializes the neural network
 
@@ -15,13 +115,30 @@ class TwoLayerNet:
         n_output, int - number of classes to predict
         hidden_layer_size, int - number of neurons in the hidden layer
         reg, float - L2 regularization strength
+        xp - NumPy-compatible array module to keep parameters in,
+          e.g. cupy to run on GPU
         """
         self.reg = reg
+        self.xp = xp
         self.layers = []
         self.layers.append(FullyConnectedLayer(n_input, hidden_layer_size))
         self.layers.append(ReLULayer())
         self.layers.append(FullyConnectedLayer(hidden_layer_size, n_output))
 
+        # Param objects live as long as the layers, so both the dict
+        # handed out by params() and the kernel argument order are built once
+        self._params = {}
+        for layer_num, layer in enumerate(self.layers):
+            for param_name, param in layer.params().items():
+                self._params[param_name + '_' + str(layer_num)] = param
+        fc1, _, fc2 = self.layers
+        self._step_params = (fc1.W, fc1.B, fc2.W, fc2.B)
+
+        if xp is not np:
+            for param in self._step_params:
+                param.value = xp.asarray(param.value)
+                param.grad = xp.zeros_like(param.value)
+
     def compute_loss_and_gradients(self, X, y):
         """
         Computes total loss and updates parameter gradients
@@ -31,49 +148,65 @@ class TwoLayerNet:
         X, np array (batch_size, input_features) - input data
         y, np array of int (batch_size) - classes
         """
-        for param in self.params().values():
-            param.grad = np.zeros_like(param.value)
-        
-        res = X.copy()
-        
-        for layer in self.layers:
-            res = layer.forward(res)
-   
-        loss, dres = softmax_with_cross_entropy(res, y)
-   
-        for layer in reversed(self.layers):
-            W = layer.params().get('W')
-            if W is not None:
-                loss_reg, dW_reg = l2_regularization(W.value, self.reg)
-                loss += loss_reg
-                W.grad += dW_reg
-            dres = layer.backward(dres)
-        
+        xp = self.xp
+        params = self._step_params
+
+        # kernels need operands of the same dtype, which follows the parameters
+        # (float64 only while a gradient check promotes one of them)
+        dtype = xp.result_type(*(param.value for param in params))
+        for param in params:
+            if param.grad.shape != param.value.shape or param.grad.dtype != param.value.dtype:
+                param.grad = xp.empty_like(param.value)
+
+        X = xp.ascontiguousarray(xp.asarray(X), dtype=dtype)
+        W1, B1, W2, B2 = (xp.ascontiguousarray(param.value, dtype=dtype) for param in params)
+        dW1, dB1, dW2, dB2 = (param.grad if param.grad.dtype == dtype else xp.empty(param.grad.shape, dtype)
+                              for param in params)
+        if xp is np:
+            y = _check_target_index(y, (X.shape[0], W2.shape[1]))
+            loss = _two_layer_step(X, W1, B1, W2, B2, y, dW1, dB1, dW2, dB2, self.reg)
+        else:
+            loss = _two_layer_step_xp(xp, X, W1, B1, W2, B2, xp.asarray(y),
+                                      dW1, dB1, dW2, dB2, self.reg)
+
+        for param, grad in zip(params, (dW1, dB1, dW2, dB2)):
+            if grad is not param.grad:
+                param.grad[...] = grad
         return loss
 
-    def predict(self, X):
+    def predict(self, X, batch_size=1000):
         """
         Produces classifier predictions on the set
 
+        Softmax is monotonic, so classes are picked by raw scores.
+        Layers are bypassed to not keep references to inputs
+
         Arguments:
-          X, np array (test_samples, num_features)
+          X, np array (test_samples, num_features) or (num_features) -
+            a single sample gives a prediction array of length 1
+          batch_size, int - number of samples processed at once,
+            bounds memory used for hidden activations
 
         Returns:
           y_pred, np.array of int (test_samples)
         """
-        res = X.copy()
-        
-        for layer in self.layers:
-            res = layer.forward(res)
-        
-        y_pred = np.argmax(res, axis=1)
+        xp = self.xp
+        fc1, _, fc2 = self.layers
+        X = np.atleast_2d(X)
+        y_pred = np.empty(X.shape[0], dtype=np.intp)
+
+        for start in range(0, X.shape[0], batch_size):
+            # activations follow the parameters as in FullyConnectedLayer
+            batch_X = xp.asarray(X[start:start + batch_size], dtype=fc1.W.value.dtype)
+            hidden = xp.dot(batch_X, fc1.W.value)
+            hidden += fc1.B.value
+            xp.maximum(hidden, 0, out=hidden)
+            scores = xp.dot(hidden, fc2.W.value)
+            scores += fc2.B.value
+            batch_pred = xp.argmax(scores, axis=1)
+            y_pred[start:start + batch_size] = batch_pred if xp is np else xp.asnumpy(batch_pred)
+
         return y_pred
 
     def params(self):
-        result = {}
-
-        for layer_num, layer in enumerate(self.layers):    
-            for param_name, param in layer.params().items():
-                result[param_name + '_' + str(layer_num)] = param
-                
-        return result
+        return self._params
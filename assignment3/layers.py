@@ -73,19 +73,24 @@ def softmax_with_cross_entropy(predictions, target_index):
       loss, single value - cross-entropy loss
       dprediction, np array same shape as predictions - gradient of predictions by loss value
     """
-    probs = softmax(predictions)
-    loss = cross_entropy_loss(probs, target_index)
-    
-    is_batch = probs.ndim == 2
-    dprediction = probs
-    
-    if is_batch:
-        dprediction[np.arange(target_index.size), target_index] -= 1
-        dprediction /= target_index.size
-    else:
-        dprediction[target_index] -= 1
-        
-    return loss, dprediction
+    is_batch = predictions.ndim == 2
+    z = predictions if is_batch else predictions[np.newaxis, :]
+    target_index = np.atleast_1d(target_index)
+    batch_size = z.shape[0]
+    rows = np.arange(batch_size)
+
+    # log(softmax) = z - log(sum(exp(z))), so the loss is taken from
+    # log-sum-exp directly instead of exp -> normalize -> log of probabilities
+    z = z - np.max(z, axis=1, keepdims=True)
+    dprediction = np.exp(z)
+    sum_exp = np.sum(dprediction, axis=1, keepdims=True)
+    loss = np.mean(np.log(sum_exp[:, 0]) - z[rows, target_index])
+
+    dprediction /= sum_exp
+    dprediction[rows, target_index] -= 1
+    dprediction /= batch_size
+
+    return loss, dprediction if is_batch else dprediction[0]
 
 
 class Param:
@@ -155,6 +160,8 @@ class FullyConnectedLayer:
         self.W.grad += np.dot(self.X.T, d_out)
         self.B.grad += np.sum(d_out, axis=0)
         d_result = np.dot(d_out, self.W.value.T)
+        # input isn't needed anymore, let it be freed before the next forward
+        self.X = None
         return d_result
 
     def params(self):